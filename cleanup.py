@@ -5,17 +5,35 @@ from PIL import Image
 import numpy as np
 import sys
 import os
-from glob import glob
+import stat
 from collections import defaultdict
 import argparse
+import multiprocessing
+import sqlite3
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 MIN_W, MIN_H = 1200, 1200*9.0/16
 SIZE = (64, 36)  # 16:9
 HASH_DIM = (8, 8)
 HASH_SIZE = HASH_DIM[0] * HASH_DIM[1]
 CACHE_FILE = 'fingerprint.db'
+CACHE_VERSION = 4
 JUNK = 'Junk'
+# Formats OpenCV can decode for hashing, plus GIF which PIL can size for -s
+IMAGE_EXTS = frozenset(['.jpg', '.jpeg', '.jpe', '.jp2', '.png', '.webp', '.bmp', '.dib',
+                        '.tiff', '.tif', '.pbm', '.pgm', '.ppm', '.pnm', '.sr', '.ras',
+                        '.gif'])
 SIMILARITY_THRESH = 8
+BAND_BITS = 8  # HASH_SIZE / BAND_BITS must be at least SIMILARITY_THRESH
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(1 << 16)], dtype=np.uint8)
 
 
 def get_args():
@@ -30,17 +48,37 @@ def get_args():
 
     return parser.parse_args()
 
-def too_small(filename):
-    """Test if an image file is too small"""
+def is_image(filename):
+    """Test if a file has an image extension"""
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTS
+
+
+def list_images():
+    """List the image files in the current folder, with their mtimes, by name"""
+    if scandir is None:
+        names = [name for name in os.listdir('.') if not name.startswith('.') and is_image(name)]
+        listing = [(name, os.stat(name)) for name in names]
+        return sorted((name, int(st.st_mtime)) for name, st in listing if stat.S_ISREG(st.st_mode))
+
+    # Directory entries know their type already, so only images get stat()ed
+    return sorted((entry.name, int(entry.stat().st_mtime)) for entry in scandir('.')
+                  if not entry.name.startswith('.') and is_image(entry.name) and entry.is_file())
+
+
+def image_size(filename):
+    """Read the dimensions of an image file from its header"""
     try:
-        img = Image.open(filename)
+        # PIL only parses the header until the pixels are accessed
+        return Image.open(filename).size
     except IOError:
         # Probably not an image
-        return False
-    w, h = img.size
-    print filename, w, h
-    if w < MIN_W or h < MIN_H:
-        return True
+        return None
+
+
+def too_small(size):
+    """Test if an image of the given dimensions is too small"""
+    w, h = size
+    return w < MIN_W or h < MIN_H
 
 
 def load_image(filename):
@@ -57,9 +95,33 @@ def load_image(filename):
     return img
 
 
+def dct_basis(n, k):
+    """Get the first k rows of the orthonormal n-point DCT-II matrix"""
+    basis = np.cos(np.pi * np.outer(np.arange(k), 2 * np.arange(n) + 1) / (2 * n))
+    basis *= np.sqrt(2.0 / n)
+    basis[0] /= np.sqrt(2)
+    return np.float32(basis)
+
+
+# Only the low-frequency corner of the DCT feeds the hash, so project onto
+# just those basis vectors rather than transforming the whole image
+DCT_ROWS = dct_basis(SIZE[1], HASH_DIM[0])
+DCT_COLS = np.ascontiguousarray(dct_basis(SIZE[0], HASH_DIM[1]).T)
+
+# Scratch space for compute_dct, reused for every image a process hashes
+_img_buf = np.empty((SIZE[1], SIZE[0]), dtype=np.float32)
+_tmp_buf = np.empty((HASH_DIM[0], SIZE[0]), dtype=np.float32)
+_dct_buf = np.empty(HASH_DIM, dtype=np.float32)
+
+
 def compute_dct(img):
-    """Get the discrete cosine transform of an image"""
-    return np.uint8(cv2.dct(np.float32(img)/255.0)*255)
+    """Get the low-frequency HASH_DIM corner of the discrete cosine transform of an image
+
+    The result is overwritten by the next call.
+    """
+    _img_buf[...] = img
+    np.dot(DCT_ROWS, _img_buf, out=_tmp_buf)
+    return np.dot(_tmp_buf, DCT_COLS, out=_dct_buf)
 
 
 def compute_phash(filename):
@@ -68,32 +130,48 @@ def compute_phash(filename):
     if img is None:
         return None
     dct = compute_dct(img)
-    dct = dct[:HASH_DIM[0], :HASH_DIM[1]]
-    avg = np.average(dct)
-    bits = [(x > avg) for x in dct.flatten()]
-    return sum([2**i * int(bits[i]) for i in range(len(bits))])
+    bits = (dct > dct.mean()).ravel()
+    # Bit i of the hash is element i, so pack them reversed into a big-endian word
+    return int(np.packbits(bits[::-1]).view('>u8')[0])
+
+
+def popcount(arr):
+    """Count the set bits in each element of an array of 64-bit integers"""
+    counts = POPCOUNT_TABLE[arr.view(np.uint16)]
+    return counts.reshape(arr.shape + (4,)).sum(axis=-1)
 
 
-def hamming(h1, h2):
-    """Compute the hamming distance (as binary strings) between two integers"""
-    h, d = 0, h1 ^ h2
-    while d:
-        h += 1
-        d &= d - 1
-    return h
+def find_similar(packed):
+    """Find index pairs of hashes fewer than SIMILARITY_THRESH bits apart"""
+    # Hashes that close differ in fewer bits than there are bands, so they
+    # must agree on at least one band; only hashes sharing a band are compared
+    mask = np.uint64((1 << BAND_BITS) - 1)
+    pairs = set()
+    for shift in range(0, HASH_SIZE, BAND_BITS):
+        # Sort by band value so that each bucket is a contiguous run; a stable
+        # sort keeps the indices within a bucket ascending
+        bands = (packed >> np.uint64(shift)) & mask
+        order = np.argsort(bands, kind='mergesort')
+        for bucket in np.split(order, np.flatnonzero(np.diff(bands[order])) + 1):
+            for k in range(len(bucket) - 1):
+                dists = popcount(packed[bucket[k+1:]] ^ packed[bucket[k]])
+                for j in bucket[k+1:][dists < SIMILARITY_THRESH].tolist():
+                    pairs.add((int(bucket[k]), j))
+
+    return sorted(pairs)
 
 
 def amalgamate(amalgams):
     """Collapse a graph described by a dict into connected components"""
-    def dfs(visited, component, current):
-        try:
-            for c in amalgams[current]:
+    def dfs(visited, start):
+        # Explicit stack, as large groups would exceed the recursion limit
+        component, stack = [start], [start]
+        while stack:
+            for c in amalgams.get(stack.pop(), ()):
                 if c not in visited:
                     visited.add(c)
                     component.append(c)
-                    dfs(visited, component, c)
-        except KeyError:
-            pass
+                    stack.append(c)
 
         return component
 
@@ -102,41 +180,80 @@ def amalgamate(amalgams):
     for i in amalgams:
         if i not in visited:
             visited.add(i)
-            components[i] = dfs(visited, [i], i)
+            components[i] = dfs(visited, i)
 
     return components
 
 
 def read_cache():
+    # Connecting would create an empty database
+    if not os.path.exists(CACHE_FILE):
+        raise ValueError('No cache file')
     try:
-        fd = open(CACHE_FILE, 'r')
-    except:
+        db = sqlite3.connect(CACHE_FILE)
+    except sqlite3.Error:
         raise ValueError('Could not open cache file')
 
-    cache = {}
-    for line in fd.readlines():
-        line = line.split()
-        try:
-            cache[line[0]] = {'mtime': int(line[1]), 'phash': int(line[2])}
-        except:
-            pass
+    db.text_factory = str
+    try:
+        if db.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+            raise ValueError('Cache file is from an older version')
+        rows = db.execute('SELECT path, mtime, phash, width, height FROM fingerprints').fetchall()
+    except sqlite3.Error:
+        raise ValueError('Could not read cache file')
+    finally:
+        db.close()
 
-    fd.close()
+    cache = {}
+    for file, mtime, phash, w, h in rows:
+        # Files that could not be hashed are retried on the next run
+        if phash is None:
+            continue
+        # SQLite integers are signed
+        phash &= 0xFFFFFFFFFFFFFFFF
+        cache[file] = {'mtime': mtime, 'phash': phash,
+                       'size': (w, h) if w is not None else None}
 
     return cache
 
 
-def write_cache(files, hashes):
+def write_cache(files, mtimes, hashes, sizes):
+    rows = []
+    for file, mtime, hash, size in zip(files, mtimes, hashes, sizes):
+        if hash is not None and hash >= 1 << 63:
+            hash -= 1 << 64
+        w, h = size or (None, None)
+        rows.append((file, mtime, hash, w, h))
+
     try:
-        fd = open(CACHE_FILE, 'w')
-    except:
+        db = sqlite3.connect(CACHE_FILE)
+        try:
+            db.execute('PRAGMA schema_version')
+        except sqlite3.DatabaseError:
+            # A text cache from an older version rather than a database
+            db.close()
+            os.remove(CACHE_FILE)
+            db = sqlite3.connect(CACHE_FILE)
+    except (sqlite3.Error, OSError):
         raise ValueError('Could not open cache file for writing')
 
-    for file, hash in zip(files, hashes):
-        mtime = int(os.path.getmtime(file))
-        fd.write('%s %s %s\n' % (file, mtime, hash))
-
-    fd.close()
+    # Manage the transaction by hand, as Python 2's sqlite3 commits before
+    # every DROP or CREATE; a crash then leaves the old cache intact
+    db.isolation_level = None
+    db.text_factory = str
+    try:
+        db.execute('BEGIN')
+        db.execute('DROP TABLE IF EXISTS fingerprints')
+        db.execute('CREATE TABLE fingerprints (path TEXT PRIMARY KEY, mtime INTEGER, '
+                   'phash INTEGER, width INTEGER, height INTEGER)')
+        db.executemany('INSERT INTO fingerprints VALUES (?, ?, ?, ?, ?)', rows)
+        db.execute('PRAGMA user_version = %d' % CACHE_VERSION)
+        db.execute('COMMIT')
+    except sqlite3.Error:
+        db.rollback()
+        raise ValueError('Could not write cache file')
+    finally:
+        db.close()
 
 
 def sort_files(cache):
@@ -175,53 +292,85 @@ if __name__ == '__main__':
         print 'Error reading cache file; ignoring'
         cache = {}
 
-    # Compute phash for all images, or extract the cached one.
+    # Extract the cached phash for all images, noting which need computing.
+    files = []
+    mtimes = []
     hashes = []
-    files = sorted(glob('*'))
-    for file in files[:]:
+    sizes = []
+    uncached = []
+    for file, mtime in list_images():
+        # Get cached info
+        info = cache.get(file)
+        if info is not None and info['mtime'] != mtime:
+            info = None
+        size = info['size'] if info else None
+
         # Move the file away if it's too small
-        if remove_small and too_small(file):
-            files.remove(file)
-            try:
-                os.rename(file, os.path.join(JUNK, file))
-                print 'Moving %s to junk as it is too small.' % (file)
-            except OSError, e:
-                print 'Failed to move %s: %s' % (file, e)
-            continue
-        try:
-            # Get cached info
-            if cache[file]['mtime'] == int(os.path.getmtime(file)):
-                phash = cache[file]['phash']
-            else:
-                phash = compute_phash(file)
-                if phash:
-                    print '%s %x' % (file, phash)
-        except KeyError:
-            # Compute hashes of uncached files and print to show we're doing stuff
-            phash = compute_phash(file)
-            if phash:
-                print '%s %x' % (file, phash)
+        if remove_small:
+            if size is None:
+                size = image_size(file)
+            if size is not None:
+                print file, size[0], size[1]
+                if too_small(size):
+                    try:
+                        os.rename(file, os.path.join(JUNK, file))
+                        print 'Moving %s to junk as it is too small.' % (file)
+                    except OSError, e:
+                        print 'Failed to move %s: %s' % (file, e)
+                    continue
 
+        if info:
+            phash = info['phash']
+        else:
+            phash = None
+            uncached.append(len(hashes))
+
+        files.append(file)
+        mtimes.append(mtime)
         hashes.append(phash)
+        sizes.append(size)
+
+    # Compute hashes of uncached files across all cores and print to show
+    # we're doing stuff
+    if uncached:
+        pool = multiprocessing.Pool()
+        # The default chunksize of 1 returns an iterator that accepts a timeout
+        results = pool.imap(compute_phash, [files[i] for i in uncached])
+        try:
+            for i in uncached:
+                # Waiting without a timeout ignores Ctrl-C on Python 2, so
+                # poll instead
+                while True:
+                    try:
+                        phash = results.next(timeout=1)
+                        break
+                    except multiprocessing.TimeoutError:
+                        pass
+                hashes[i] = phash
+                if phash:
+                    print '%s %x' % (files[i], phash)
+        except KeyboardInterrupt:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
 
     # Find pairs of images whose phash is similar
+    hashed = [i for i, phash in enumerate(hashes) if phash is not None]
+    packed = np.array([hashes[i] for i in hashed], dtype=np.uint64)
     amalgams = defaultdict(list)
-    for i, file_a in enumerate(files):
-        if hashes[i] is None:
-            continue
-        for j, file_b in enumerate(files[i+1:]):
-            j += i+1
-            if hashes[j] is None:
-                continue
-            if hamming(hashes[i], hashes[j]) < SIMILARITY_THRESH:
-                amalgams[file_a].append(file_b)
-                amalgams[file_b].append(file_a)
+    for i, j in find_similar(packed):
+        file_a, file_b = files[hashed[i]], files[hashed[j]]
+        amalgams[file_a].append(file_b)
+        amalgams[file_b].append(file_a)
 
     # Group together all images which are similar
     amalgams = dict(amalgams)
     amalgams = amalgamate(amalgams)
 
     # Rename similar files to to be <name>.jpg, <name>_v1.jpg, <name>_v2.jpg etc
+    file_index = dict((file, i) for i, file in enumerate(files))
     for similar in amalgams.values():
         similar.sort(key=sort_files(cache))
         # Alphabetically first file remains the same
@@ -241,9 +390,11 @@ if __name__ == '__main__':
                 except OSError, e:
                     print 'Failed to rename %s: %s' % (oldname, e)
                     continue
-                files[files.index(oldname)] = newname
+                index = file_index.pop(oldname)
+                files[index] = newname
+                file_index[newname] = index
 
-    write_cache(files, hashes)
+    write_cache(files, mtimes, hashes, sizes)
 
     print 'Done.'
 